@@ -1,5 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from django.db.models import Exists, OuterRef, Subquery
 from django.utils.translation import gettext_lazy as _
 from rangefilter.filters import DateTimeRangeFilter
 
@@ -12,6 +13,7 @@ admin.site.register(User, UserAdmin)
 @admin.register(Wallet)
 class WalletAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'amount')
+    list_select_related = ('user',)
     list_filter = ('user__is_staff',)
     search_fields = ('id', 'user__username')
 
@@ -30,7 +32,11 @@ class IsSubscriptionPayedFilter(admin.SimpleListFilter):
         if self.value() == '1':
             return queryset.payed()
         if self.value() == '0':
-            return queryset.exclude(id__in=queryset.payed())
+            payed_time_ranges = SubscriptionTimeRange.objects \
+                .filter(subscription=OuterRef('pk')) \
+                .current() \
+                .payed()
+            return queryset.filter(~Exists(payed_time_ranges))
         return queryset
 
 
@@ -61,23 +67,31 @@ class SubscriptionTimeRangeStackedInline(admin.StackedInline):
 @admin.register(Subscription)
 class SubscriptionAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'is_payed', 'is_canceled')
+    list_select_related = ('user',)
     list_filter = ('user__is_staff', IsSubscriptionPayedFilter, IsSubscriptionCanceledFilter)
     search_fields = ('id', 'user__username')
     inlines = [SubscriptionTimeRangeStackedInline]
 
+    def get_queryset(self, request):
+        # is_payed and is_canceled are annotated so the changelist does not
+        # query time ranges for each row
+        time_ranges = SubscriptionTimeRange.objects.filter(subscription=OuterRef('pk'))
+        return super().get_queryset(request).annotate(
+            current_time_range_payed=Exists(time_ranges.current().payed()),
+            last_time_range_canceled_at=Subquery(time_ranges.order_by('-ends_at').values('canceled_at')[:1]),
+        )
+
     def is_payed(self, obj):
-        return obj.time_ranges.current().payed().exists()
+        return obj.current_time_range_payed
 
     def is_canceled(self, obj):
-        last_time_range = obj.time_ranges.order_by('-ends_at').first()
-        if last_time_range:
-            return last_time_range.canceled_at is not None
-        return False
+        return obj.last_time_range_canceled_at is not None
 
 
 @admin.register(Transaction)
 class TransactionAdmin(admin.ModelAdmin):
     list_display = ('id', 'from_wallet', 'to_wallet', 'amount')
+    list_select_related = ('from_wallet', 'to_wallet')
     list_filter = (('created_at', DateTimeRangeFilter),)
     search_fields = ('from_wallet__id', 'to_wallet__id', 'amount')
     readonly_fields = ('created_at',)
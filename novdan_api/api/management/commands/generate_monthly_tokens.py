@@ -1,7 +1,8 @@
 
 from django.core.management.base import BaseCommand, CommandError
 
-from ...utils import generate_subscription_time_ranges_for_month, generate_tokens_for_month
+from ...utils import (generate_subscription_time_ranges_for_month,
+                      generate_tokens_for_month, get_month_bounds)
 
 
 class Command(BaseCommand):
@@ -10,10 +11,13 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         self.stdout.write('Starting ...')
 
+        # both steps must work on the same month even if run at its boundary
+        month = get_month_bounds()
+
         self.stdout.write('generate_subscription_time_ranges_for_month ...')
-        generate_subscription_time_ranges_for_month()
+        generate_subscription_time_ranges_for_month(month)
 
         self.stdout.write('generate_tokens_for_month ...')
-        generate_tokens_for_month()
+        generate_tokens_for_month(month)
 
         self.stdout.write('Done')
@@ -3,7 +3,7 @@ from django.core.management.base import BaseCommand
 from oauth2_provider.models import get_application_model
 
 from ...models import Wallet
-from ...utils import generate_tokens_for_month_for_wallet, transfer_tokens
+from ...utils import generate_tokens_for_month_for_wallets, transfer_tokens
 
 User = get_user_model()
 Application = get_application_model()
@@ -56,11 +56,9 @@ class Command(BaseCommand):
         user1_wallet = Wallet.objects.get(user=user1)
         user2_wallet = Wallet.objects.get(user=user2)
 
-        generate_tokens_for_month_for_wallet(admin_wallet)
+        generate_tokens_for_month_for_wallets(Wallet.objects.filter(pk=admin_wallet.pk))
 
         transfer_tokens(admin_wallet, user1_wallet, 5)
-        admin_wallet.refresh_from_db() # get updated values from db not CombinedExpression
         transfer_tokens(admin_wallet, user2_wallet, 10)
-        admin_wallet.refresh_from_db() # get updated values from db not CombinedExpression
 
         self.stdout.write('Done')
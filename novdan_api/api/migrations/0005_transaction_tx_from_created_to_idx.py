@@ -0,0 +1,17 @@
+# Generated by Django 3.2.8 on 2026-10-14 19:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_user_customer_id'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['from_wallet', 'created_at', 'to_wallet'], include=('amount',), name='tx_from_created_to_idx'),
+        ),
+    ]
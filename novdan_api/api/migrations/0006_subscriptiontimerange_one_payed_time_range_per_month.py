@@ -0,0 +1,43 @@
+# Generated by Django 3.2.8 on 2026-10-14 19:13
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def check_duplicate_payed_time_ranges(apps, schema_editor):
+    # activating a subscription used to check and then write, so concurrent
+    # activations could leave more than one payed time range for a month
+    SubscriptionTimeRange = apps.get_model('api', 'SubscriptionTimeRange')
+
+    duplicates = SubscriptionTimeRange.objects \
+        .filter(payed_at__isnull=False) \
+        .values('subscription_id', 'starts_at') \
+        .annotate(count=Count('id')) \
+        .filter(count__gt=1) \
+        .order_by('subscription_id', 'starts_at')
+
+    if duplicates:
+        months = ', '.join(
+            f"subscription {duplicate['subscription_id']} starting at {duplicate['starts_at'].isoformat()}"
+            for duplicate in duplicates
+        )
+        raise RuntimeError(
+            f'Cannot add constraint one_payed_time_range_per_month, these months have more than one payed '
+            f'SubscriptionTimeRange: {months}. Keep the range whose payment_token matches the payment provider '
+            f'and delete the others (or clear their payed_at and payment_token) in the admin, then run migrate again.'
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_transaction_tx_from_created_to_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_duplicate_payed_time_ranges, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='subscriptiontimerange',
+            constraint=models.UniqueConstraint(condition=models.Q(('payed_at__isnull', False)), fields=('subscription', 'starts_at'), name='one_payed_time_range_per_month'),
+        ),
+    ]
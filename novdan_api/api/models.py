@@ -30,7 +30,7 @@ class SubscriptionQuerySet(models.QuerySet):
 
         return self.filter(
             time_range__starts_at__lte=time,
-            time_range__ends_at__gte=time,
+            time_range__ends_at__gt=time,
         )
 
     def payed(self, time=None):
@@ -39,7 +39,7 @@ class SubscriptionQuerySet(models.QuerySet):
 
         return self.filter(
             time_range__starts_at__lte=time,
-            time_range__ends_at__gte=time,
+            time_range__ends_at__gt=time,
             time_range__payed_at__isnull=False,
         )
 
@@ -55,7 +55,7 @@ class SubscriptionQuerySet(models.QuerySet):
             .filter(pk__in=last_time_ranges, canceled_at__isnull=False) \
             .values_list('subscription_id', flat=True)
 
-        return self.model.objects.filter(pk__in=canceled_subscription_ids)
+        return self.filter(pk__in=canceled_subscription_ids)
 
 
 class Subscription(models.Model):
@@ -75,7 +75,7 @@ class SubscriptionTimeRangeQuerySet(models.QuerySet):
         if time is None:
             time = timezone.now()
 
-        return self.filter(starts_at__lte=time, ends_at__gte=time)
+        return self.filter(starts_at__lte=time, ends_at__gt=time)
 
     def payed(self):
         return self.filter(payed_at__isnull=False)
@@ -105,6 +105,15 @@ class SubscriptionTimeRange(models.Model):
         related_query_name='time_range',
     )
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['subscription', 'starts_at'],
+                condition=models.Q(payed_at__isnull=False),
+                name='one_payed_time_range_per_month',
+            ),
+        ]
+
 
 class Transaction(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
@@ -121,3 +130,13 @@ class Transaction(models.Model):
         related_name='incoming_transactions',
         related_query_name='incoming_transaction',
     )
+
+    class Meta:
+        indexes = [
+            # covers the monthly per-receiver sums in calculate_receivers_percentage
+            models.Index(
+                fields=['from_wallet', 'created_at', 'to_wallet'],
+                include=['amount'],
+                name='tx_from_created_to_idx',
+            ),
+        ]
@@ -1,123 +1,180 @@
-from django.db import transaction
+from dataclasses import dataclass
+from datetime import datetime
+from itertools import islice
+
+from django.db import IntegrityError, connection, transaction
 from django.db.models import F, Sum
 from django.utils import timezone
 
+from .exceptions import (ActiveSubscriptionExists, LowBalance,
+                         NoActiveSubscription)
 from .models import Subscription, SubscriptionTimeRange, Transaction, Wallet
-from .serializers import UserSerializer
-
 
-def get_start_of_month(datetime):
-    return timezone.datetime(datetime.year, datetime.month, 1, tzinfo=datetime.tzinfo)
+BATCH_SIZE = 1000
 
 
-def get_end_of_month(datetime):
-    return timezone.datetime(datetime.year, datetime.month + 1, 1, tzinfo=datetime.tzinfo) - timezone.timedelta(seconds=1)
+def get_start_of_month(time):
+    return timezone.datetime(time.year, time.month, 1, tzinfo=time.tzinfo)
 
 
-def calculate_receivers_percentage(from_wallet):
-    now = timezone.now()
-    year = now.year
-    month = now.month
-
-    transactions = Transaction.objects.filter(
-        from_wallet=from_wallet,
-        created_at__year=year,
-        created_at__month=month,
+def get_start_of_next_month(time):
+    # months are half-open ranges [start of month, start of next month)
+    return timezone.datetime(
+        time.year + (time.month == 12),
+        time.month % 12 + 1,
+        1,
+        tzinfo=time.tzinfo,
     )
 
-    sum = transactions.aggregate(Sum('amount')).get('amount__sum', None) or 0
-    if sum <= 0:
-        return 0, []
 
-    results = transactions.values('to_wallet').order_by('to_wallet').annotate(sum=Sum('amount'))
-    percentages = [{
-        'user': UserSerializer(Wallet.objects.get(id=result['to_wallet']).user).data,
-        'percentage': result['sum'] / sum,
-    } for result in results]
-
-    return sum, percentages
+@dataclass(frozen=True)
+class MonthBounds:
+    now: datetime
+    start: datetime
+    next_start: datetime
+    seconds: int
 
 
-def _get_number_of_seconds_in_month(time=None):
+def get_month_bounds(time=None):
+    """
+    Computes bounds of the month containing time (or now). Compute them once
+    per request and pass them on so all queries share the same "now".
+    """
     if time is None:
         time = timezone.now()
 
-    return int((get_end_of_month(time) - get_start_of_month(time)).total_seconds())
+    start = get_start_of_month(time)
+    next_start = get_start_of_next_month(time)
+
+    return MonthBounds(
+        now=time,
+        start=start,
+        next_start=next_start,
+        seconds=int((next_start - start).total_seconds()),
+    )
+
 
+def calculate_receivers_percentage(from_wallet, month=None):
+    if month is None:
+        month = get_month_bounds()
+
+    # group by receiving wallet and join only the user fields that are
+    # returned, the serializer would be much slower for the same output
+    receiving_wallets = list(Wallet.objects \
+        .filter(
+            incoming_transaction__from_wallet=from_wallet,
+            incoming_transaction__created_at__gte=month.start,
+            incoming_transaction__created_at__lt=month.next_start,
+        ) \
+        .annotate(sum=Sum('incoming_transaction__amount')) \
+        .order_by('id') \
+        .values('user__username', 'user__first_name', 'user__last_name', 'sum'))
+
+    # the total is the sum of all groups so it does not need a separate query
+    total = sum(wallet['sum'] for wallet in receiving_wallets)
+    if total <= 0:
+        return 0, []
 
-def generate_tokens_for_month(time=None):
+    # same fields as UserSerializer
+    percentages = [{
+        'user': {
+            'username': wallet['user__username'],
+            'full_name': f"{wallet['user__first_name']} {wallet['user__last_name']}".strip(),
+        },
+        'percentage': wallet['sum'] / total,
+    } for wallet in receiving_wallets]
+
+    return total, percentages
+
+
+def generate_tokens_for_month(month=None):
     """
     Fills wallets of all users that have a valid subscription with tokens for
     the current month. The amount of tokens in each wallet is set to the number
     of seconds in the current month.
     """
-    if time is None:
-        time = timezone.now()
-
-    seconds = _get_number_of_seconds_in_month(time)
-
-    user_ids_with_subscription = Subscription.objects.current(time).values_list('user_id', flat=True)
-
-    Wallet.objects.filter(user_id__in=user_ids_with_subscription).update(amount=seconds)
+    if month is None:
+        month = get_month_bounds()
 
+    generate_tokens_for_month_for_wallets(
+        Wallet.objects.filter(user_id__in=Subscription.objects.current(month.now).values('user_id')),
+        month,
+    )
 
-def generate_tokens_for_month_for_wallet(wallet, time=None):
-    if time is None:
-        time = timezone.now()
 
-    seconds = _get_number_of_seconds_in_month(time)
-    wallet.amount = seconds
-    wallet.save()
+def generate_tokens_for_month_for_wallets(wallets, month=None):
+    """
+    Sets the amount of tokens in the given wallets queryset to the number of
+    seconds in the current month.
+    """
+    if month is None:
+        month = get_month_bounds()
 
+    wallets.update(amount=month.seconds)
 
-def _create_subscription_time_range(time, subscription_id):
-    starts_at = get_start_of_month(time)
-    ends_at = get_end_of_month(time)
 
+def _create_subscription_time_range(month, subscription_id, **kwargs):
     return SubscriptionTimeRange.objects.create(
-        starts_at=starts_at,
-        ends_at=ends_at,
+        starts_at=month.start,
+        ends_at=month.next_start,
         subscription_id=subscription_id,
+        **kwargs,
     )
 
 
-def generate_subscription_time_ranges_for_month(time=None):
+def generate_subscription_time_ranges_for_month(month=None):
     """
     Creates a new SubscriptionTimeRange for the current month for all
     subscriptions where their last time range was not canceled.
 
     Asserts if any ranges for current month already exist!
     """
-    if time is None:
-        time = timezone.now()
+    if month is None:
+        month = get_month_bounds()
 
     # make sure there are not any time ranges for this month already
-    month_has_time_ranges = SubscriptionTimeRange.objects.current(time).exists()
+    month_has_time_ranges = SubscriptionTimeRange.objects.current(month.now).exists()
     assert not month_has_time_ranges, "A SubscriptionTimeRange for current month already exists!"
 
     # get last time range for each subscription
     last_time_ranges = SubscriptionTimeRange.objects.all() \
         .order_by('subscription', '-ends_at') \
-        .distinct('subscription')
+        .distinct('subscription') \
+        .values_list('subscription_id', 'canceled_at')
 
-    # filter non canceled time ranges from last time ranges
-    # this needs to happen separately otherwise filter is executed before distinct
-    non_canceled_subscription_ids = SubscriptionTimeRange.objects \
-        .filter(pk__in=last_time_ranges, canceled_at__isnull=True) \
-        .values_list('subscription_id', flat=True)
+    with transaction.atomic():
+        # filter non canceled time ranges from last time ranges
+        # this happens in python because in the query filter is executed before distinct
+        subscription_ids = (
+            subscription_id
+            for subscription_id, canceled_at in last_time_ranges.iterator(chunk_size=BATCH_SIZE)
+            if canceled_at is None
+        )
 
-    for subscription_id in non_canceled_subscription_ids:
-        _create_subscription_time_range(time, subscription_id)
+        # stream subscription ids and insert them in batches so memory use does
+        # not grow with the number of subscriptions
+        while batch := list(islice(subscription_ids, BATCH_SIZE)):
+            SubscriptionTimeRange.objects.bulk_create([
+                SubscriptionTimeRange(
+                    starts_at=month.start,
+                    ends_at=month.next_start,
+                    subscription_id=subscription_id,
+                ) for subscription_id in batch
+            ])
 
 
-def activate_subscription(user, payment_token):
+def activate_subscription(user, payment_token, month=None):
     """
     Activates payed subscription for user.
 
+    Does nothing if current time range is already payed with the same payment
+    token, so repeated payment notifications succeed.
+
     Asserts if payment token is none or empty!
-    Asserts if subscription is already payed!
+    Raises ActiveSubscriptionExists if subscription is already payed!
     """
-    time = timezone.now()
+    if month is None:
+        month = get_month_bounds()
 
     # make sure payment token is not empty
     assert payment_token is not None and payment_token != '', "Payment token is none or empty!"
@@ -125,65 +182,130 @@ def activate_subscription(user, payment_token):
     with transaction.atomic():
         subscription, _ = Subscription.objects.get_or_create(user=user)
 
-        # make sure subscription is not already payed
-        assert not subscription.time_ranges.current(time).payed().exists(), "Subscription is already payed!"
-
-        # try getting current not payed subscription time range if it exists
-        time_range = subscription.time_ranges.current(time).not_payed().first()
-
-        # create new time range if it does not exist
-        if not time_range:
-            time_range = _create_subscription_time_range(time, subscription.id)
-
-        # add payment data and save
-        time_range.payed_at = time
-        time_range.payment_token = payment_token
-        time_range.save()
+        # add payment data to current not payed time range if it exists or
+        # create a new payed time range, the database rejects a second payed
+        # time range for the same month; only time ranges of this subscription
+        # are written here so one_payed_time_range_per_month is the only
+        # constraint that can fail
+        try:
+            with transaction.atomic():
+                updated = subscription.time_ranges \
+                    .current(month.now) \
+                    .not_payed() \
+                    .update(payed_at=month.now, payment_token=payment_token)
+
+                if not updated:
+                    _create_subscription_time_range(
+                        month,
+                        subscription.id,
+                        payed_at=month.now,
+                        payment_token=payment_token,
+                    )
+        except IntegrityError:
+            current_payed_time_ranges = subscription.time_ranges.current(month.now).payed()
+            if current_payed_time_ranges.filter(payment_token=payment_token).exists():
+                # this payment was already recorded, keep the wallet as it is
+                return
+            raise ActiveSubscriptionExists
 
         # fill wallet with tokens for this month
-        generate_tokens_for_month_for_wallet(Wallet.objects.get(user=user), time)
+        generate_tokens_for_month_for_wallets(Wallet.objects.filter(user=user), month)
 
 
-def cancel_subscription(user):
+def cancel_subscription(user, month=None):
     """
-    Cancels subscription for user.
+    Cancels subscription for user. Canceling an already canceled subscription
+    succeeds and keeps the original cancelation time.
 
-    Asserts if subscription is not active!
+    Raises NoActiveSubscription if subscription is not payed!
     """
-    time = timezone.now()
-
-    with transaction.atomic():
-        subscription = Subscription.objects.get(user=user)
+    if month is None:
+        month = get_month_bounds()
 
-        # make sure subscription is payed
-        assert subscription.time_ranges.current(time).payed().exists(), "Subscription is not payed!"
+    current_payed_time_ranges = SubscriptionTimeRange.objects \
+        .filter(subscription__user=user) \
+        .current(month.now) \
+        .payed()
 
-        # get current payed subscription time range
-        time_range = subscription.time_ranges.current(time).payed().first()
+    # add cancelation data to current payed not canceled time range
+    updated = current_payed_time_ranges.not_canceled().update(canceled_at=month.now)
 
-        # add cancelation data and save
-        time_range.canceled_at = time
-        time_range.save()
+    if not updated and not current_payed_time_ranges.canceled().exists():
+        raise NoActiveSubscription
 
 
-def transfer_tokens(from_wallet, to_wallet, amount):
-    """
-    Transfers tokens from one wallet to another and creates a transaction.
-
-    Asserts if sending wallet balance is too low!
-    """
-    assert from_wallet.amount >= amount, "Wallet balance too low!"
-
+def _transfer_tokens_in_single_statement(from_wallet, to_wallet, amount):
+    # postgres can chain data modifying statements in a CTE, so the debit, the
+    # credit and the transaction insert are a single statement; the credit
+    # and the insert only happen if the debit matched the wallet
     with transaction.atomic():
-        from_wallet.amount = F('amount') - amount
-        to_wallet.amount = F('amount') + amount
-
-        new_transaction = Transaction(
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH debited AS (
+                    UPDATE {Wallet._meta.db_table}
+                    SET amount = amount - %(amount)s
+                    WHERE id = %(from_wallet_id)s AND amount >= %(amount)s
+                    RETURNING id
+                ), credited AS (
+                    UPDATE {Wallet._meta.db_table}
+                    SET amount = amount + %(amount)s
+                    WHERE id = %(to_wallet_id)s AND EXISTS (SELECT 1 FROM debited)
+                    RETURNING id
+                ), inserted AS (
+                    INSERT INTO {Transaction._meta.db_table} (created_at, amount, from_wallet_id, to_wallet_id)
+                    SELECT %(created_at)s, %(amount)s, debited.id, credited.id
+                    FROM debited, credited
+                    RETURNING id
+                )
+                SELECT (SELECT count(*) FROM debited), (SELECT count(*) FROM inserted)
+                """,
+                {
+                    'amount': amount,
+                    'from_wallet_id': from_wallet.pk,
+                    'to_wallet_id': to_wallet.pk,
+                    'created_at': timezone.now(),
+                },
+            )
+            debited, inserted = cursor.fetchone()
+
+        # postgres runs every statement of the CTE, so raising inside the
+        # transaction rolls back a debit that was not credited
+        if debited != 1:
+            raise LowBalance
+        if inserted != 1:
+            raise Wallet.DoesNotExist('Receiving wallet does not exist.')
+
+
+def _transfer_tokens_in_transaction(from_wallet, to_wallet, amount):
+    with transaction.atomic():
+        # the balance check is part of the update so it can not race with
+        # another transfer from the same wallet
+        debited = Wallet.objects \
+            .filter(pk=from_wallet.pk, amount__gte=amount) \
+            .update(amount=F('amount') - amount)
+        if debited != 1:
+            raise LowBalance
+
+        credited = Wallet.objects.filter(pk=to_wallet.pk).update(amount=F('amount') + amount)
+        if credited != 1:
+            raise Wallet.DoesNotExist('Receiving wallet does not exist.')
+
+        Transaction.objects.create(
             from_wallet=from_wallet,
             to_wallet=to_wallet,
             amount=amount,
         )
 
-        from_wallet.save()
-        to_wallet.save()
-        new_transaction.save()
+
+def transfer_tokens(from_wallet, to_wallet, amount):
+    """
+    Transfers tokens from one wallet to another and creates a transaction.
+
+    Raises LowBalance if sending wallet balance is too low!
+    Raises Wallet.DoesNotExist if receiving wallet no longer exists!
+    """
+    if connection.vendor == 'postgresql':
+        _transfer_tokens_in_single_statement(from_wallet, to_wallet, amount)
+    else:
+        _transfer_tokens_in_transaction(from_wallet, to_wallet, amount)
@@ -24,13 +24,13 @@ from rest_framework.response import Response
 from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
-from .exceptions import (ActiveSubscriptionExists, LowBalance,
-                         NoActiveSubscription, invalid_receiver_error)
+from .exceptions import (ActiveSubscriptionExists, NoActiveSubscription,
+                         invalid_receiver_error)
 from .models import Subscription, Wallet
 from .serializers import (ChangePasswordSerializer, RegisterSerializer,
                           UserSerializer, WalletSerializer)
 from .utils import (activate_subscription, calculate_receivers_percentage,
-                    cancel_subscription, transfer_tokens)
+                    cancel_subscription, get_month_bounds, transfer_tokens)
 
 User = get_user_model()
 Application = get_application_model()
@@ -107,14 +107,16 @@ class ConnectExtensionView(APIView):
 
 class StatusView(APIView):
     def get(self, request):
+        month = get_month_bounds()
+
         user_serializer = UserSerializer(self.request.user)
 
         wallet = Wallet.objects.filter(user=self.request.user).first()
         wallet_serializer = WalletSerializer(wallet)
 
-        active_subscription_exists = Subscription.objects.filter(user=self.request.user).payed().exists()
+        active_subscription_exists = Subscription.objects.filter(user=self.request.user).payed(month.now).exists()
 
-        sum, percentages = calculate_receivers_percentage(wallet)
+        sum, percentages = calculate_receivers_percentage(wallet, month)
 
         return Response({
             'user': user_serializer.data,
@@ -167,9 +169,6 @@ class TransferView(APIView):
         if not self.request.user.is_staff and from_wallet.user != self.request.user:
             raise PermissionDenied
 
-        if from_wallet.amount < amount:
-            raise LowBalance
-
         transfer_tokens(from_wallet, to_wallet, amount)
 
         return Response({ 'success': True })
@@ -229,7 +228,9 @@ class SubscriptionActivateView(APIView):
             traceback.print_exc()
             raise APIException
 
-        activate_subscription(self.request.user, payment_token)
+        # month bounds are computed after the payment call returns so the
+        # payment is recorded at the time and in the month it was made
+        activate_subscription(self.request.user, payment_token, get_month_bounds())
 
         return Response({ 'success': True })
 
@@ -278,10 +279,12 @@ class SubscriptionChargedView(APIView):
         kind = self._get_kind(self.request.data, 'kind')
         payment_token = self._get_subscription_id(self.request.data, 'subscription_id', user)
 
+        month = get_month_bounds()
+
         if kind == 'subscription_charged_successfully':
-            activate_subscription(user, payment_token)
+            activate_subscription(user, payment_token, month)
         elif kind == 'subscription_canceled':
-            cancel_subscription(user)
+            cancel_subscription(user, month)
         else:
             raise RestValidationError({ 'kind': ['This field must be a valid kind.'] })
 
@@ -290,11 +293,13 @@ class SubscriptionChargedView(APIView):
 
 class SubscriptionCancelView(APIView):
     def post(self, request):
-        if not Subscription.objects.filter(user=self.request.user).payed().exists():
+        month = get_month_bounds()
+
+        if not Subscription.objects.filter(user=self.request.user).payed(month.now).exists():
             raise NoActiveSubscription
 
         subscription = Subscription.objects.get(user=self.request.user)
-        time_range = subscription.time_ranges.current().payed().first()
+        time_range = subscription.time_ranges.current(month.now).payed().first()
 
         try:
             r = requests.post(
@@ -312,7 +317,8 @@ class SubscriptionCancelView(APIView):
             traceback.print_exc()
             raise APIException
 
-        cancel_subscription(self.request.user)
+        # month bounds are computed again after the payment provider call
+        cancel_subscription(self.request.user, get_month_bounds())
 
         return Response({ 'success': True })
 
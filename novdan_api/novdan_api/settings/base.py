@@ -115,6 +115,10 @@ DATABASES = {
     }
 }
 
+# SQLite ignores the INCLUDE columns of the covering transaction index, the
+# index itself is still created and the include only matters on PostgreSQL
+SILENCED_SYSTEM_CHECKS = ['models.W040']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators